@@ -1,9 +1,14 @@
+import calendar
 import os
 import math
 import re
-from datetime import date, timedelta
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from functools import lru_cache
 
-from flask import Flask, render_template, request, redirect
+from flask import Flask, Response, render_template, request, redirect
 from flask_login import (
     LoginManager,
     login_user,
@@ -13,9 +18,11 @@ from flask_login import (
     current_user,
 )
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, inspect
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, text, inspect
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError
-from werkzeug.security import check_password_hash
+from werkzeug.security import check_password_hash, generate_password_hash
 
 app = Flask(__name__, instance_relative_config=True)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-key")
@@ -32,15 +39,39 @@ else:
     app.config["SQLALCHEMY_DATABASE_URI"] = (
         f"sqlite:///{os.path.join(app.instance_path, 'inventory_control.db')}"
     )
+    # 長いクエリ文が多いので、SQLite のプリペアドステートメントキャッシュを広げておく
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "connect_args": {"cached_statements": 512},
+    }
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# テンプレートのコンパイル結果をファイルにキャッシュし、再起動後のパースを省く
+jinja_cache_dir = os.path.join(app.instance_path, "jinja_cache")
+os.makedirs(jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
+
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login_form"
 
 
+# SQLAlchemy はエンジン単位でコネクションをプールして再利用するため、
+# SQLite の PRAGMA はコネクション生成時に一度だけ設定する。
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
 class Company(db.Model):
     __tablename__ = "companies"
 
@@ -89,11 +120,23 @@ class Material(db.Model):
     memo = db.Column(db.Text)
 
 
+# 出庫・廃棄は在庫を減らす。集計のたびに名前を文字列比較しなくて済むよう、
+# 符号（+1 / -1）を名前から計算する生成列として持たせる。
+OUTGOING_MOVEMENT_TYPE_NAMES = ("出庫", "廃棄")
+OUTGOING_MOVEMENT_TYPE_SQL = ", ".join(
+    f"'{name}'" for name in OUTGOING_MOVEMENT_TYPE_NAMES
+)
+MOVEMENT_TYPE_SIGN_SQL = (
+    f"CASE WHEN name IN ({OUTGOING_MOVEMENT_TYPE_SQL}) THEN -1 ELSE 1 END"
+)
+
+
 class MovementType(db.Model):
     __tablename__ = "movement_types"
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
+    sign = db.Column(db.SmallInteger, db.Computed(MOVEMENT_TYPE_SIGN_SQL))
 
 
 class InventoryMovement(db.Model):
@@ -111,6 +154,15 @@ class InventoryMovement(db.Model):
     memo = db.Column(db.Text)
 
 
+class MaterialStoreStock(db.Model):
+    __tablename__ = "material_store_stock"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    material_id = db.Column(db.Integer, db.ForeignKey("materials.id"), primary_key=True)
+    store_id = db.Column(db.Integer, db.ForeignKey("stores.id"), primary_key=True)
+    quantity = db.Column(db.Float, nullable=False)
+
+
 class ForecastOrder(db.Model):
     __tablename__ = "forecast_orders"
 
@@ -160,6 +212,7 @@ class DailyReport(db.Model):
     working_hours = db.Column(db.Float)
     next_material_delivery = db.Column(db.String)
     remarks = db.Column(db.Text)
+    updated_at = db.Column(db.String)
 
 
 class DailyReportOrder(db.Model):
@@ -192,6 +245,7 @@ class StocktakeSession(db.Model):
     status = db.Column(db.String, server_default="draft")
     notes = db.Column(db.Text)
     confirmed_at = db.Column(db.String)
+    updated_at = db.Column(db.String)
 
 
 class StocktakeItem(db.Model):
@@ -226,7 +280,85 @@ class StocktakeOrderItem(db.Model):
 def load_user(user_id):
     if not user_id:
         return None
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+
+    # 毎リクエスト呼ばれるので、ユーザー行は参照キャッシュに載せて使い回す。
+    # セッションに属さない User を毎回作り直すので、commit による expire の影響も受けない。
+    # ログイン時にしか使わない password_hash は読まない。
+    def load():
+        row = db_fetchone(
+            "SELECT id, name, email, role, store_id FROM users WHERE id = ?",
+            (user_id,),
+        )
+        return dict(row) if row else None
+
+    values = cached_reference(user_cache_key(user_id), load)
+    return User(**values) if values else None
+
+
+def user_cache_key(user_id):
+    return f"user:{user_id}"
+
+
+# ---------------------------------------------
+# 変数を使わない静的なページ
+# ---------------------------------------------
+# 一度レンダリングした結果を使い回す。デバッグ時はテンプレートの変更を反映するため毎回描画する。
+static_pages = {}
+
+
+def render_static_page(template_name):
+    if app.debug:
+        return render_template(template_name)
+    page = static_pages.get(template_name)
+    if page is None:
+        page = render_template(template_name).encode("utf-8")
+        static_pages[template_name] = page
+    return Response(page, mimetype="text/html")
+
+
+# ---------------------------------------------
+# 詳細ページの条件付き GET
+# ---------------------------------------------
+# 日報・棚卸を書き換えるたびに updated_at を更新し、それを ETag にする。
+# 表示内容はログインユーザーによって変わるので、ユーザー ID も含める。
+def current_timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def detail_etag(kind, row_id, updated_at):
+    return f"{kind}-{row_id}-{updated_at}-{current_user.id}"
+
+
+# 詳細画面は材料名・単位も表示するので、材料の名前変更や削除のときは
+# その材料を含む日報・棚卸の updated_at も更新して ETag を変える
+def touch_material_documents(material_id):
+    now = current_timestamp()
+    db_execute(
+        """
+        UPDATE daily_reports SET updated_at = ?
+        WHERE id IN (SELECT daily_report_id FROM daily_report_orders WHERE material_id = ?)
+        """,
+        (now, material_id),
+    )
+    db_execute(
+        """
+        UPDATE stocktake_sessions SET updated_at = ?
+        WHERE id IN (
+            SELECT session_id FROM stocktake_items WHERE material_id = ?
+            UNION
+            SELECT session_id FROM stocktake_order_items WHERE material_id = ?
+        )
+        """,
+        (now, material_id, material_id),
+    )
+
+
+def detail_response(body, etag, status=200):
+    response = Response(body, status=status, mimetype="text/html")
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 # ---------------------------------------------
@@ -234,7 +366,7 @@ def load_user(user_id):
 # ---------------------------------------------
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return render_static_page("index.html")
 
 
 # ---------------------------------------------
@@ -242,7 +374,11 @@ def index():
 # ---------------------------------------------
 @app.route("/login", methods=["GET"])
 def login_form():
-    return render_template("login.html")
+    return render_static_page("login.html")
+
+
+# 存在しないメールアドレスでも同じだけハッシュ計算をして、応答時間からアカウントの有無を推測されないようにする
+DUMMY_PASSWORD_HASH = generate_password_hash(os.urandom(16).hex())
 
 
 @app.route("/login", methods=["POST"])
@@ -251,7 +387,10 @@ def login():
     password = request.form["password"]
 
     user = User.query.filter_by(email=email).first()
-    if user and check_password_hash(user.password_hash, password):
+    if user is None:
+        check_password_hash(DUMMY_PASSWORD_HASH, password)
+    elif check_password_hash(user.password_hash, password):
+        clear_reference_cache(user_cache_key(user.id))
         login_user(user)
         return redirect("/")
 
@@ -261,6 +400,7 @@ def login():
 @app.route("/logout")
 @login_required
 def logout():
+    clear_reference_cache(user_cache_key(current_user.id))
     logout_user()
     return redirect("/login")
 
@@ -269,11 +409,10 @@ def is_admin_user():
     return getattr(current_user, "role", None) == "admin"
 
 
+# 値は request.form / request.args から来る str か None。
+# float() / int() は前後の空白を無視し、空白だけの文字列は ValueError になる。
 def parse_float(value):
-    if value is None:
-        return None
-    value = str(value).strip()
-    if value == "":
+    if not value:
         return None
     try:
         return float(value)
@@ -282,10 +421,7 @@ def parse_float(value):
 
 
 def parse_int(value):
-    if value is None:
-        return None
-    value = str(value).strip()
-    if value == "":
+    if not value:
         return None
     try:
         return int(value)
@@ -293,32 +429,112 @@ def parse_int(value):
         return None
 
 
+def is_year_month(value):
+    """Return True for a "YYYY-MM" string with a month between 01 and 12."""
+    return (
+        len(value) == 7
+        and value[4] == "-"
+        and value[:4].isdecimal()
+        and value[5:].isdecimal()
+        and 1 <= int(value[5:]) <= 12
+    )
+
+
+ORDER_QTY_KEY_RE = re.compile(r"order_qty_(\d+)")
+
+
+def parse_order_quantities(form):
+    """Yield (material_id, quantity) for each positive order_qty_<id> field."""
+    match_key = ORDER_QTY_KEY_RE.fullmatch
+    for key, value in form.items():
+        match = match_key(key)
+        if match is None:
+            continue
+        material_id = int(match.group(1))
+        if not material_id:
+            continue
+        quantity = parse_int(value)
+        if quantity is None or quantity <= 0:
+            continue
+        yield material_id, quantity
+
+
+def parse_movement_form(form):
+    """Return the movement columns as bound values, or None if a required field is missing."""
+    store_id = parse_int(form.get("store_id"))
+    material_id = parse_int(form.get("material_id"))
+    movement_type_id = parse_int(form.get("movement_type_id"))
+    quantity = parse_float(form.get("quantity"))
+    datetime_value = form.get("datetime")
+    memo = form.get("memo", "")
+
+    # float() は "inf" / "nan" も受け付けるが、在庫の集計が壊れるので未入力と同じ扱いにする
+    if quantity is None or not math.isfinite(quantity):
+        return None
+    if not (store_id and material_id and movement_type_id and datetime_value):
+        return None
+    return store_id, material_id, movement_type_id, quantity, datetime_value, memo
+
+
+def parse_store_minimums(form, material_id, store_rows):
+    rows = []
+    for store in store_rows:
+        min_value = parse_float(form.get(f"minimum_stock_store_{store['id']}"))
+        if min_value is not None:
+            rows.append((material_id, store["id"], min_value))
+    return rows
+
+
+# 同じクエリ文は毎回 ? を :pN に書き換えず、変換済みの text() を使い回す
+@lru_cache(maxsize=512)
+def compile_sql(sql):
+    parts = sql.split("?")
+    converted = parts[0] + "".join(
+        f":p{index}{part}" for index, part in enumerate(parts[1:], start=1)
+    )
+    return text(converted), len(parts) - 1
+
+
 def normalize_params(sql, params):
-    if params is None or params == () or params == []:
-        return sql, {}
     if isinstance(params, dict):
-        return sql, params
-    out = []
-    index = 0
-    for ch in sql:
-        if ch == "?":
-            index += 1
-            out.append(f":p{index}")
-        else:
-            out.append(ch)
-    bind_params = {f"p{i}": params[i - 1] for i in range(1, index + 1)}
-    return "".join(out), bind_params
+        return text(sql), params
+    statement, placeholder_count = compile_sql(sql)
+    if not params:
+        return statement, {}
+    bind_params = {f"p{i}": params[i - 1] for i in range(1, placeholder_count + 1)}
+    return statement, bind_params
 
 
 def db_execute(sql, params=None):
-    sql, bind_params = normalize_params(sql, params)
-    return db.session.execute(text(sql), bind_params)
+    statement, bind_params = normalize_params(sql, params)
+    return db.session.execute(statement, bind_params)
+
+
+def db_executemany(sql, seq_of_params):
+    seq_of_params = list(seq_of_params)
+    if not seq_of_params:
+        return None
+    statement, _ = normalize_params(sql, seq_of_params[0])
+    bind_params = [
+        {f"p{i}": value for i, value in enumerate(params, start=1)}
+        for params in seq_of_params
+    ]
+    return db.session.execute(statement, bind_params)
 
 
 def db_fetchall(sql, params=None):
     return db_execute(sql, params).mappings().all()
 
 
+def db_stream(sql, params=None, batch=500):
+    """Yield rows in batches from a server-side cursor instead of loading them all."""
+    statement, bind_params = normalize_params(sql, params)
+    result = db.session.execute(
+        statement, bind_params, execution_options={"stream_results": True}
+    )
+    return result.mappings().yield_per(batch)
+
+
 def db_fetchone(sql, params=None):
     return db_execute(sql, params).mappings().first()
 
@@ -327,10 +543,229 @@ def db_fetchscalar(sql, params=None):
     return db_execute(sql, params).scalar()
 
 
+def begin_write_transaction():
+    """Take the SQLite write lock up front for multi-statement writes."""
+    if db.engine.dialect.name != "sqlite":
+        return
+    connection = db.session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+# ---------------------------------------------
+# 参照テーブルのキャッシュ
+# ---------------------------------------------
+REFERENCE_CACHE_TTL_SECONDS = 60
+
+_reference_cache = {}
+
+
+def cached_reference(key, loader):
+    now = time.monotonic()
+    entry = _reference_cache.get(key)
+    if entry is None or now - entry[0] > REFERENCE_CACHE_TTL_SECONDS:
+        entry = (now, loader())
+        _reference_cache[key] = entry
+    return entry[1]
+
+
+def clear_reference_cache(*keys):
+    for key in keys or list(_reference_cache):
+        _reference_cache.pop(key, None)
+
+
+def get_stores():
+    return cached_reference(
+        "stores",
+        lambda: tuple(
+            dict(row) for row in db_fetchall("SELECT id, name FROM stores ORDER BY id")
+        ),
+    )
+
+
+def get_store_ids():
+    return cached_reference(
+        "store_ids", lambda: frozenset(store["id"] for store in get_stores())
+    )
+
+
+def get_stores_by_id():
+    return cached_reference(
+        "stores_by_id", lambda: {store["id"]: store for store in get_stores()}
+    )
+
+
+def get_material_categories():
+    return cached_reference(
+        "material_categories",
+        lambda: tuple(
+            dict(row)
+            for row in db_fetchall(
+                "SELECT id, category_name FROM material_categories ORDER BY id"
+            )
+        ),
+    )
+
+
+def get_material_categories_by_id():
+    return cached_reference(
+        "material_categories_by_id",
+        lambda: {category["id"]: category for category in get_material_categories()},
+    )
+
+
+def get_movement_types():
+    return cached_reference(
+        "movement_types",
+        lambda: tuple(
+            dict(row)
+            for row in db_fetchall("SELECT id, name FROM movement_types ORDER BY id")
+        ),
+    )
+
+
+def get_movement_type_id(name):
+    for movement_type in get_movement_types():
+        if movement_type["name"] == name:
+            return movement_type["id"]
+    return None
+
+
+# ---------------------------------------------
+# 材料×店舗の在庫集計テーブル
+# ---------------------------------------------
+# inventory_movements への書き込みのたびにトリガーで該当する材料×店舗の行だけを
+# 集計し直す。差分の足し引きにしないのは、浮動小数点の誤差を SUM と揃えるため。
+MATERIAL_STORE_STOCK_SELECT = """
+    SELECT im.material_id,
+           im.store_id,
+           SUM(im.quantity * mt.sign) AS quantity
+    FROM inventory_movements im
+    JOIN movement_types mt ON mt.id = im.movement_type_id
+"""
+
+
+def material_store_stock_refresh_sql(ref):
+    return f"""
+        DELETE FROM material_store_stock
+        WHERE material_id = {ref}.material_id AND store_id = {ref}.store_id;
+        INSERT INTO material_store_stock (material_id, store_id, quantity)
+        {MATERIAL_STORE_STOCK_SELECT}
+        WHERE im.material_id = {ref}.material_id AND im.store_id = {ref}.store_id
+        GROUP BY im.material_id, im.store_id;
+    """
+
+
+def ensure_material_store_stock_triggers():
+    if db.engine.dialect.name == "sqlite":
+        for event_name, refs in (
+            ("insert", ("NEW",)),
+            ("delete", ("OLD",)),
+            ("update", ("OLD", "NEW")),
+        ):
+            refresh_sql = "".join(material_store_stock_refresh_sql(ref) for ref in refs)
+            # 集計式を変えたときに古いトリガーが残らないよう、作り直す
+            db.session.execute(
+                text(f"DROP TRIGGER IF EXISTS trg_inventory_movements_stock_{event_name}")
+            )
+            db.session.execute(
+                text(
+                    f"""
+                    CREATE TRIGGER trg_inventory_movements_stock_{event_name}
+                    AFTER {event_name.upper()} ON inventory_movements
+                    BEGIN
+                        {refresh_sql}
+                    END
+                    """
+                )
+            )
+        return
+
+    # PostgreSQL では同じ材料×店舗への同時書き込みを advisory lock で直列化する
+    db.session.execute(
+        text(
+            f"""
+            CREATE OR REPLACE FUNCTION refresh_material_store_stock() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    PERFORM pg_advisory_xact_lock(OLD.material_id, OLD.store_id);
+                    {material_store_stock_refresh_sql("OLD")}
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    PERFORM pg_advisory_xact_lock(NEW.material_id, NEW.store_id);
+                    {material_store_stock_refresh_sql("NEW")}
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """
+        )
+    )
+    db.session.execute(
+        text(
+            "DROP TRIGGER IF EXISTS trg_inventory_movements_stock ON inventory_movements"
+        )
+    )
+    db.session.execute(
+        text(
+            """
+            CREATE TRIGGER trg_inventory_movements_stock
+            AFTER INSERT OR UPDATE OR DELETE ON inventory_movements
+            FOR EACH ROW EXECUTE FUNCTION refresh_material_store_stock()
+            """
+        )
+    )
+
+
+def backfill_material_store_stock():
+    db.session.execute(text("DELETE FROM material_store_stock"))
+    db.session.execute(
+        text(
+            f"""
+            INSERT INTO material_store_stock (material_id, store_id, quantity)
+            {MATERIAL_STORE_STOCK_SELECT}
+            GROUP BY im.material_id, im.store_id
+            """
+        )
+    )
+
+
+# テーブル・インデックス・トリガーの定義を変えたら SCHEMA_VERSION を上げること。
+# SQLite では PRAGMA user_version に記録し、最新なら起動時の DDL をまとめて省く。
+# PostgreSQL には user_version がないので schema_meta テーブルに記録し、
+# 複数ワーカーが同時に起動しても advisory lock で 1 つずつ確認する。
+SCHEMA_VERSION = 6
+
+
 def ensure_schema():
+    is_sqlite = db.engine.dialect.name == "sqlite"
+    if is_sqlite:
+        if db_fetchscalar("PRAGMA user_version") >= SCHEMA_VERSION:
+            return
+    else:
+        db_execute("SELECT pg_advisory_xact_lock(hashtext('ensure_schema'))")
+        db_execute("CREATE TABLE IF NOT EXISTS schema_meta (version INTEGER NOT NULL)")
+        if (db_fetchscalar("SELECT MAX(version) FROM schema_meta") or 0) >= SCHEMA_VERSION:
+            db.session.commit()
+            return
+
+    stock_table_exists = inspect(db.engine).has_table("material_store_stock")
     db.create_all()
 
     inspector = inspect(db.engine)
+    if "movement_types" in inspector.get_table_names():
+        columns = {column["name"] for column in inspector.get_columns("movement_types")}
+        if "sign" not in columns:
+            # SQLite は ALTER TABLE で STORED の生成列を追加できないので VIRTUAL にする
+            storage = "VIRTUAL" if is_sqlite else "STORED"
+            db.session.execute(
+                text(
+                    f"""
+                    ALTER TABLE movement_types ADD COLUMN sign SMALLINT
+                    GENERATED ALWAYS AS ({MOVEMENT_TYPE_SIGN_SQL}) {storage}
+                    """
+                )
+            )
     if "stocktake_sessions" in inspector.get_table_names():
         columns = {column["name"] for column in inspector.get_columns("stocktake_sessions")}
         if "session_type" not in columns:
@@ -343,6 +778,14 @@ def ensure_schema():
             db.session.execute(
                 text("ALTER TABLE stocktake_sessions ADD COLUMN count_month TEXT")
             )
+    for table_name in ("daily_reports", "stocktake_sessions"):
+        if table_name not in inspector.get_table_names():
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table_name)}
+        if "updated_at" not in columns:
+            db.session.execute(
+                text(f"ALTER TABLE {table_name} ADD COLUMN updated_at TEXT")
+            )
 
     db.session.execute(
         text(
@@ -392,6 +835,14 @@ def ensure_schema():
             """
         )
     )
+    db.session.execute(
+        text(
+            """
+            CREATE INDEX IF NOT EXISTS idx_stocktake_sessions_store_date
+            ON stocktake_sessions(store_id, count_date)
+            """
+        )
+    )
     db.session.execute(
         text(
             """
@@ -401,30 +852,202 @@ def ensure_schema():
             """
         )
     )
+    db.session.execute(
+        text(
+            """
+            CREATE INDEX IF NOT EXISTS idx_inventory_movements_material_store
+            ON inventory_movements(material_id, store_id, movement_type_id, quantity)
+            """
+        )
+    )
+    # 入出庫一覧は同じ日時の行を id で並べるので、id まで含めた索引にする
+    db.session.execute(text("DROP INDEX IF EXISTS idx_inventory_movements_datetime"))
+    db.session.execute(
+        text(
+            """
+            CREATE INDEX IF NOT EXISTS idx_inventory_movements_datetime_id
+            ON inventory_movements(datetime DESC, id DESC)
+            """
+        )
+    )
+    # material_store_stock は (material_id, store_id) の主キーで引くので、店舗順の索引は使われない
+    db.session.execute(text("DROP INDEX IF EXISTS idx_material_store_stock_store"))
+    ensure_material_store_stock_triggers()
+    if not stock_table_exists:
+        backfill_material_store_stock()
+    if is_sqlite:
+        db.session.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+        db.session.execute(text("PRAGMA optimize"))
+    else:
+        db_execute("DELETE FROM schema_meta")
+        db_execute("INSERT INTO schema_meta (version) VALUES (?)", (SCHEMA_VERSION,))
     db.session.commit()
 
 
+# ---------------------------------------------
+# 共通クエリ
+# ---------------------------------------------
+# 複数のハンドラで使う SQL は定数にまとめ、compile_sql のキャッシュと
+# 接続ごとのプリペアドステートメントキャッシュを同じ文字列で共有する。
+DAILY_REPORT_SQL = "SELECT * FROM daily_reports WHERE id = ?"
+# 編集・削除・確定で使う列だけを読む（notes などの長い列は読まない）
+STOCKTAKE_SESSION_SQL = """
+    SELECT store_id, status, session_type, count_date
+    FROM stocktake_sessions
+    WHERE id = ?
+"""
+STOCKTAKE_SESSION_WITH_STORE_SQL = """
+    SELECT ss.*, s.name AS store_name
+    FROM stocktake_sessions ss
+    JOIN stores s ON ss.store_id = s.id
+    WHERE ss.id = ?
+"""
+
+
+# ---------------------------------------------
+# 主要クエリの実行計画チェック
+# ---------------------------------------------
+# スキーマ変更でインデックスが効かなくなっても気付けるよう、起動時に
+# EXPLAIN QUERY PLAN を確認し、大きいテーブルを全件走査していれば警告を出す。
+MOVEMENT_LIST_SQL = """
+    SELECT im.id, im.quantity, im.datetime, im.memo,
+           m.name AS material_name,
+           mt.name AS movement_type_name,
+           s.name AS store_name
+    FROM inventory_movements im
+    JOIN materials m ON im.material_id = m.id
+    JOIN movement_types mt ON im.movement_type_id = mt.id
+    JOIN stores s ON im.store_id = s.id
+    ORDER BY im.datetime DESC, im.id DESC
+"""
+MOVEMENT_LIST_PAGE_SIZE = 200
+# 棚卸数と現在庫の差分を SQL 側で計算し、差のある材料だけ棚卸調整として登録する
+STOCKTAKE_ADJUSTMENT_SQL = """
+    INSERT INTO inventory_movements
+    (store_id, material_id, movement_type_id, quantity, datetime, memo)
+    SELECT ?, si.material_id, ?, si.counted_quantity - COALESCE(st.quantity, 0), ?, ?
+    FROM stocktake_items si
+    JOIN materials m ON si.material_id = m.id
+    LEFT JOIN material_store_stock st
+           ON st.material_id = si.material_id AND st.store_id = ?
+    WHERE si.session_id = ?
+      AND ABS(si.counted_quantity - COALESCE(st.quantity, 0)) >= 1e-9
+"""
+HOT_QUERIES = (
+    ("movement_list", MOVEMENT_LIST_SQL),
+    ("stocktake_confirm", STOCKTAKE_ADJUSTMENT_SQL),
+    (
+        "material_store_stock refresh",
+        MATERIAL_STORE_STOCK_SELECT
+        + """
+        WHERE im.material_id = ? AND im.store_id = ?
+        GROUP BY im.material_id, im.store_id
+        """,
+    ),
+)
+LARGE_TABLES = ("inventory_movements", "material_store_stock")
+# 新しい SQLite は実行計画に「SCAN im」のように別名しか出さないので、
+# FROM / JOIN 句から別名→テーブル名の対応を作って引き直す
+TABLE_ALIAS_RE = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+
+
+def table_aliases(sql):
+    aliases = {}
+    for table, alias in TABLE_ALIAS_RE.findall(sql):
+        aliases[table] = table
+        if alias:
+            aliases.setdefault(alias, table)
+    return aliases
+
+
+HOT_QUERY_CHECK_MIN_MOVEMENTS = 1000
+
+
+def check_hot_query_plans():
+    if db.engine.dialect.name != "sqlite":
+        return
+    # 行数が少ないうちは SQLite が全件走査を選ぶのが正しいので判定しない
+    has_enough_rows = db_fetchscalar(
+        "SELECT 1 FROM inventory_movements LIMIT 1 OFFSET ?",
+        (HOT_QUERY_CHECK_MIN_MOVEMENTS - 1,),
+    )
+    if not has_enough_rows:
+        return
+    for name, sql in HOT_QUERIES:
+        aliases = table_aliases(sql)
+        dummy_params = (0,) * sql.count("?")
+        for row in db_fetchall(f"EXPLAIN QUERY PLAN {sql}", dummy_params):
+            detail = row["detail"]
+            full_scan = False
+            if detail.startswith("SCAN") and "USING" not in detail:
+                # 古い SQLite は「SCAN TABLE inventory_movements AS im」と出す
+                words = detail.removeprefix("SCAN TABLE ").removeprefix("SCAN ").split()
+                full_scan = bool(words) and aliases.get(words[0], words[0]) in LARGE_TABLES
+            if "TEMP B-TREE" in detail or full_scan:
+                app.logger.warning("Query plan regression in %s: %s", name, detail)
+
+
 with app.app_context():
     ensure_schema()
+    check_hot_query_plans()
+    # 起動時に全テンプレートを読み込んでバイトコードキャッシュを温めておく
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+
+
+# ---------------------------------------------
+# 在庫状況の判定
+# ---------------------------------------------
+# (quantity < minimum) + 2 * (quantity > minimum * 2) で引く。
+STOCK_STATUS_CLASSES = ("stock-ok", "stock-low", "stock-high", "stock-ok")
+
+
+def parse_minimum_stock(minimum_stock):
+    """Return the minimum stock as a non-negative float, or None if unknown."""
+    if minimum_stock is None:
+        return None
+    try:
+        return max(float(minimum_stock), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_stock(quantity, minimum_value):
+    """Return the CSS class that represents current stock vs. minimum."""
+    if minimum_value is None:
+        return "stock-unknown"
+    if not minimum_value:
+        return "stock-ok"
+    quantity = quantity or 0
+    return STOCK_STATUS_CLASSES[
+        (quantity < minimum_value) + 2 * (quantity > minimum_value * 2)
+    ]
 
 
 # ---------------------------------------------
 # 材料一覧
 # ---------------------------------------------
+@dataclass(slots=True)
+class MaterialView:
+    """One row of the materials list, with its per-store cells pre-assembled."""
+
+    id: int
+    name: str
+    unit: str
+    price_per_unit: float
+    minimum_stock: float
+    category_id: int
+    memo: str
+    total_stock: float = 0
+    total_status: str = "stock-unknown"
+    # (store_id, 在庫数, 在庫状況の CSS クラス, 店舗別最低在庫量) を店舗 ID 順に並べる
+    per_store: list = field(default_factory=list)
+
+
 @app.route("/materials")
 @login_required
 def materials_list():
-    materials = db_fetchall("SELECT * FROM materials")
-    stores = db_fetchall("SELECT id, name FROM stores")
-    store_minimum_rows = db_fetchall(
-        "SELECT material_id, store_id, minimum_stock FROM material_store_minimums"
-    )
-
-    per_store_minimums = {}
-    for row in store_minimum_rows:
-        material_id = row["material_id"]
-        store_id = row["store_id"]
-        per_store_minimums.setdefault(material_id, {})[store_id] = row["minimum_stock"]
+    stores = get_stores()
 
     store_param = request.args.get("store_id", "all")
     selected_store_id = None
@@ -434,92 +1057,78 @@ def materials_list():
             store_id_int = int(store_param)
         except ValueError:
             return redirect("/materials")
-        selected_store = next((store for store in stores if store["id"] == store_id_int), None)
+        selected_store = get_stores_by_id().get(store_id_int)
         if not selected_store:
             return redirect("/materials")
         selected_store_id = store_id_int
 
-    stock_rows = db_fetchall(
-        """
-        SELECT im.material_id,
-               im.store_id,
-               COALESCE(
-                   SUM(
-                       CASE
-                           WHEN mt.name IN ('出庫', '廃棄') THEN -im.quantity
-                           ELSE im.quantity
-                       END
-                   ),
-                   0
-               ) AS store_stock
-        FROM inventory_movements im
-        JOIN movement_types mt ON im.movement_type_id = mt.id
-        GROUP BY im.material_id, im.store_id
-        """
+    # 材料と、材料×店舗ごとの在庫・最低在庫量を 1 クエリで取得し、そのまま各行に詰める。
+    # 別々のクエリにすると、間で材料が追加・削除されたときに両者が食い違う。
+    # 店舗ごとの在庫状況は classify_stock と同じ判定を SQL の CASE で行う。
+    # 古い SQLite データでは最低在庫量に '' などの文字列が残っていることがあり、
+    # 数値でない値は「x + 0 = x」が成り立たないので stock-unknown になる。
+    # 店舗が 1 件もなくても材料は表示するので、stores は LEFT JOIN にする。
+    store_filter = "s.id = ?" if selected_store_id is not None else "1 = 1"
+    rows = db_execute(
+        f"""
+        WITH cells AS (
+            SELECT m.id, m.name, m.unit, m.price_per_unit, m.minimum_stock,
+                   m.category_id, m.memo,
+                   s.id AS store_id,
+                   st.quantity AS store_stock,
+                   msm.minimum_stock AS store_minimum,
+                   COALESCE(msm.minimum_stock, m.minimum_stock) AS applicable_minimum
+            FROM materials m
+            LEFT JOIN stores s ON {store_filter}
+            LEFT JOIN material_store_stock st
+                   ON st.material_id = m.id AND st.store_id = s.id
+            LEFT JOIN material_store_minimums msm
+                   ON msm.material_id = m.id AND msm.store_id = s.id
+        )
+        SELECT id, name, unit, price_per_unit, minimum_stock, category_id, memo,
+               store_id,
+               store_stock,
+               store_minimum,
+               CASE
+                   WHEN applicable_minimum IS NULL
+                        OR NOT (applicable_minimum + 0 = applicable_minimum)
+                   THEN 'stock-unknown'
+                   WHEN applicable_minimum <= 0 THEN 'stock-ok'
+                   WHEN COALESCE(store_stock, 0) < applicable_minimum THEN 'stock-low'
+                   WHEN COALESCE(store_stock, 0) > applicable_minimum * 2 THEN 'stock-high'
+                   ELSE 'stock-ok'
+               END AS stock_status
+        FROM cells
+        ORDER BY id, store_id
+        """,
+        (selected_store_id,) if selected_store_id is not None else None,
     )
-    stock_levels = {}
-    per_store_stock = {}
-    for row in stock_rows:
-        material_id = row["material_id"]
-        store_id = row["store_id"]
-        qty = row["store_stock"]
-        stock_levels[material_id] = stock_levels.get(material_id, 0) + qty
-        if material_id not in per_store_stock:
-            per_store_stock[material_id] = {}
-        per_store_stock[material_id][store_id] = qty
-
-    def classify_stock(quantity, minimum_stock):
-        """Return the CSS class that represents current stock vs. minimum."""
-        if minimum_stock is None:
-            return "stock-unknown"
-        try:
-            minimum_value = float(minimum_stock)
-        except (TypeError, ValueError):
-            return "stock-unknown"
-
-        if minimum_value <= 0:
-            minimum_value = 0
-
-        quantity = quantity or 0
-        if minimum_value and quantity < minimum_value:
-            return "stock-low"
-        if minimum_value and quantity > minimum_value * 2:
-            return "stock-high"
-        return "stock-ok"
 
-    stock_statuses = {}
-    for material in materials:
-        min_stock = material["minimum_stock"]
-        material_id = material["id"]
-        stock_statuses[material_id] = {
-            "total": classify_stock(stock_levels.get(material_id, 0), min_stock),
-            "stores": {},
-        }
-        for store in stores:
-            per_store = per_store_stock.get(material_id, {}).get(store["id"], 0)
-            store_minimum = per_store_minimums.get(material_id, {}).get(store["id"])
-            applicable_min = store_minimum if store_minimum is not None else min_stock
-            stock_statuses[material_id]["stores"][store["id"]] = classify_stock(
-                per_store, applicable_min
-            )
-
-    category_rows = db_fetchall("SELECT id, category_name FROM material_categories")
+    materials = []
+    material = None
+    for row in rows:
+        if material is None or material.id != row[0]:
+            material = MaterialView(*row[:7])
+            materials.append(material)
+        store_id, qty, store_minimum, stock_status = row[7:]
+        if store_id is None:
+            continue
+        if qty is None:
+            qty = 0
+        else:
+            material.total_stock += qty
+        material.per_store.append((store_id, qty, stock_status, store_minimum))
 
-    categories = {}
-    for category in category_rows:
-        categories[category["id"]] = {
-            "id": category["id"],
-            "category_name": category["category_name"],
-        }
+    if selected_store_id is None:
+        for material in materials:
+            material.total_status = classify_stock(
+                material.total_stock, parse_minimum_stock(material.minimum_stock)
+            )
 
     return render_template(
         "materials_list.html",
         materials=materials,
-        categories=categories,
-        stock_levels=stock_levels,
-        per_store_stock=per_store_stock,
-        per_store_minimums=per_store_minimums,
-        stock_statuses=stock_statuses,
+        categories=get_material_categories_by_id(),
         stores=stores,
         selected_store_id=selected_store_id,
         selected_store=selected_store,
@@ -532,8 +1141,8 @@ def materials_list():
 @app.route("/materials/add", methods=["GET"])
 @login_required
 def add_material_form():
-    categories = db_fetchall("SELECT id, category_name FROM material_categories")
-    stores = db_fetchall("SELECT id, name FROM stores")
+    categories = get_material_categories()
+    stores = get_stores()
     return render_template("add_material.html", categories=categories, stores=stores)
 
 
@@ -547,14 +1156,10 @@ def add_material():
     unit = request.form["unit"]
     price = parse_float(request.form.get("price"))
     minimum_stock = parse_float(request.form.get("minimum_stock"))
-    category_id = request.form.get("category_id")
+    category_id = parse_int(request.form.get("category_id"))
     memo = request.form.get("memo", "")
 
-    if category_id:
-        category_id = int(category_id)
-    else:
-        category_id = None
-
+    begin_write_transaction()
     result = db_execute(
         """
         INSERT INTO materials 
@@ -566,23 +1171,14 @@ def add_material():
     )
     material_id = result.scalar()
 
-    store_rows = db_fetchall("SELECT id FROM stores")
-    for store in store_rows:
-        field_name = f"minimum_stock_store_{store['id']}"
-        raw_value = request.form.get(field_name)
-        if raw_value is None or raw_value == "":
-            continue
-        try:
-            min_value = float(raw_value)
-        except ValueError:
-            continue
-        db_execute(
-            """
-            INSERT INTO material_store_minimums (material_id, store_id, minimum_stock)
-            VALUES (?, ?, ?)
-            """,
-            (material_id, store["id"], min_value),
-        )
+    minimum_rows = parse_store_minimums(request.form, material_id, get_stores())
+    db_executemany(
+        """
+        INSERT INTO material_store_minimums (material_id, store_id, minimum_stock)
+        VALUES (?, ?, ?)
+        """,
+        minimum_rows,
+    )
 
     db.session.commit()
 
@@ -595,11 +1191,18 @@ def add_material():
 @app.route("/materials/<int:material_id>/edit", methods=["GET"])
 @login_required
 def edit_material_form(material_id):
-    material = db_fetchone("SELECT * FROM materials WHERE id = ?", (material_id,))
+    material = db_fetchone(
+        """
+        SELECT id, name, unit, price_per_unit, minimum_stock, category_id, memo
+        FROM materials
+        WHERE id = ?
+        """,
+        (material_id,),
+    )
 
-    categories = db_fetchall("SELECT id, category_name FROM material_categories")
+    categories = get_material_categories()
 
-    stores = db_fetchall("SELECT id, name FROM stores")
+    stores = get_stores()
     store_minimum_rows = db_fetchall(
         "SELECT store_id, minimum_stock FROM material_store_minimums WHERE material_id = ?",
         (material_id,),
@@ -625,14 +1228,13 @@ def edit_material(material_id):
     unit = request.form["unit"]
     price = parse_float(request.form.get("price"))
     minimum_stock = parse_float(request.form.get("minimum_stock"))
-    category_id = request.form.get("category_id")
+    category_id = parse_int(request.form.get("category_id"))
     memo = request.form.get("memo", "")
 
-    if category_id:
-        category_id = int(category_id)
-    else:
-        category_id = None
-
+    begin_write_transaction()
+    previous = db_fetchone("SELECT name, unit FROM materials WHERE id = ?", (material_id,))
+    if previous and (previous["name"], previous["unit"]) != (name, unit):
+        touch_material_documents(material_id)
     db_execute(
         """
         UPDATE materials
@@ -642,26 +1244,29 @@ def edit_material(material_id):
         """,
         (name, unit, price, minimum_stock, category_id, memo, material_id),
     )
-    db_execute(
-        "DELETE FROM material_store_minimums WHERE material_id = ?", (material_id,)
+    minimum_rows = parse_store_minimums(request.form, material_id, get_stores())
+    db_executemany(
+        """
+        INSERT INTO material_store_minimums (material_id, store_id, minimum_stock)
+        VALUES (?, ?, ?)
+        ON CONFLICT (material_id, store_id)
+        DO UPDATE SET minimum_stock = excluded.minimum_stock
+        """,
+        minimum_rows,
     )
-
-    store_rows = db_fetchall("SELECT id FROM stores")
-    for store in store_rows:
-        field_name = f"minimum_stock_store_{store['id']}"
-        raw_value = request.form.get(field_name)
-        if raw_value is None or raw_value == "":
-            continue
-        try:
-            min_value = float(raw_value)
-        except ValueError:
-            continue
+    kept_store_ids = [row[1] for row in minimum_rows]
+    if kept_store_ids:
+        placeholders = ", ".join("?" for _ in kept_store_ids)
         db_execute(
-            """
-            INSERT INTO material_store_minimums (material_id, store_id, minimum_stock)
-            VALUES (?, ?, ?)
+            f"""
+            DELETE FROM material_store_minimums
+            WHERE material_id = ? AND store_id NOT IN ({placeholders})
             """,
-            (material_id, store["id"], min_value),
+            (material_id, *kept_store_ids),
+        )
+    else:
+        db_execute(
+            "DELETE FROM material_store_minimums WHERE material_id = ?", (material_id,)
         )
 
     db.session.commit()
@@ -675,7 +1280,10 @@ def edit_material(material_id):
 @app.route("/materials/<int:material_id>/delete", methods=["GET"])
 @login_required
 def delete_material_confirm(material_id):
-    material = db_fetchone("SELECT * FROM materials WHERE id=?", (material_id,))
+    material = db_fetchone(
+        "SELECT id, name, unit, category_id FROM materials WHERE id = ?",
+        (material_id,),
+    )
 
     return render_template("delete_material.html", material=material)
 
@@ -686,6 +1294,8 @@ def delete_material_confirm(material_id):
 @app.route("/materials/<int:material_id>/delete", methods=["POST"])
 @login_required
 def delete_material(material_id):
+    begin_write_transaction()
+    touch_material_documents(material_id)
     db_execute("DELETE FROM materials WHERE id = ?", (material_id,))
     db.session.commit()
 
@@ -698,20 +1308,18 @@ def delete_material(material_id):
 @app.route("/movements")
 @login_required
 def movement_list():
-    movements = db_fetchall(
-        """
-        SELECT im.id, im.quantity, im.datetime, im.memo,
-               m.name AS material_name,
-               mt.name AS movement_type_name,
-               s.name AS store_name
-        FROM inventory_movements im
-        JOIN materials m ON im.material_id = m.id
-        JOIN movement_types mt ON im.movement_type_id = mt.id
-        JOIN stores s ON im.store_id = s.id
-        ORDER BY im.datetime DESC
-        """
+    # 履歴は増え続けるので、新しい順に MOVEMENT_LIST_PAGE_SIZE 件ずつ表示する
+    page = max(parse_int(request.args.get("page")) or 1, 1)
+    rows = db_fetchall(
+        MOVEMENT_LIST_SQL + " LIMIT ? OFFSET ?",
+        (MOVEMENT_LIST_PAGE_SIZE + 1, (page - 1) * MOVEMENT_LIST_PAGE_SIZE),
+    )
+    return render_template(
+        "movement_list.html",
+        movements=rows[:MOVEMENT_LIST_PAGE_SIZE],
+        page=page,
+        has_next=len(rows) > MOVEMENT_LIST_PAGE_SIZE,
     )
-    return render_template("movement_list.html", movements=movements)
 
 
 # ---------------------------------------------
@@ -721,8 +1329,8 @@ def movement_list():
 @login_required
 def movement_add_form():
     materials = db_fetchall("SELECT id, name FROM materials")
-    movement_types = db_fetchall("SELECT id, name FROM movement_types")
-    stores = db_fetchall("SELECT id, name FROM stores")
+    movement_types = get_movement_types()
+    stores = get_stores()
 
     return render_template(
         "movement_add.html",
@@ -738,30 +1346,18 @@ def movement_add_form():
 @app.route("/movements/add", methods=["POST"])
 @login_required
 def movement_add():
-    store_id = request.form.get("store_id")
-    material_id = request.form.get("material_id")
-    movement_type_id = request.form.get("movement_type_id")
-    quantity = request.form.get("quantity")
-    memo = request.form.get("memo", "")
-    datetime_value = request.form.get("datetime")
-
-    if not (store_id and material_id and movement_type_id and quantity and datetime_value):
+    values = parse_movement_form(request.form)
+    if values is None:
         return "必要な項目が未入力です。", 400
 
+    begin_write_transaction()
     db_execute(
         """
         INSERT INTO inventory_movements
         (store_id, material_id, movement_type_id, quantity, datetime, memo)
         VALUES (?, ?, ?, ?, ?, ?)
         """,
-        (
-            store_id,
-            material_id,
-            movement_type_id,
-            quantity,
-            datetime_value,
-            memo,
-        ),
+        values,
     )
     db.session.commit()
 
@@ -774,29 +1370,28 @@ def movement_add():
 @app.route("/daily_reports")
 @login_required
 def daily_reports_list():
-    stores = db_fetchall("SELECT id, name FROM stores ORDER BY id")
+    stores = get_stores()
 
     selected_store_id = current_user.store_id
     store_param = request.args.get("store_id")
     if is_admin_user() and store_param:
         parsed_store_id = parse_int(store_param)
-        if parsed_store_id and any(store["id"] == parsed_store_id for store in stores):
+        if parsed_store_id in get_store_ids():
             selected_store_id = parsed_store_id
 
-    reports = db_fetchall(
+    # 日報は店舗ごとに毎日増えるので、全件をリストにせず少しずつ読みながら描画する。
+    # 途中で失敗したときに途切れたページを 200 で返さないよう、応答はまとめて返す
+    reports = db_stream(
         """
-        SELECT dr.*, s.name AS store_name
+        SELECT dr.id, dr.date, dr.sales, dr.production_sets, dr.working_hours
         FROM daily_reports dr
-        JOIN stores s ON dr.store_id = s.id
         WHERE dr.store_id = ?
         ORDER BY dr.date DESC, dr.id DESC
         """,
         (selected_store_id,),
     )
 
-    selected_store = next(
-        (store for store in stores if store["id"] == selected_store_id), None
-    )
+    selected_store = get_stores_by_id().get(selected_store_id)
     return render_template(
         "daily_reports_list.html",
         reports=reports,
@@ -807,63 +1402,136 @@ def daily_reports_list():
     )
 
 
-def fetch_store_stock_levels(store_id):
-    rows = db_fetchall(
+def recommended_order_quantity(minimum, stock):
+    """Return the whole units needed to bring stock up to the minimum."""
+    if minimum is None:
+        return 0
+    try:
+        minimum_value = float(minimum)
+    except (TypeError, ValueError):
+        return 0
+    if not minimum_value > 0:
+        return 0
+    shortage = minimum_value - float(stock)
+    if shortage > 0:
+        return int(math.ceil(shortage))
+    return 0
+
+
+def sync_daily_report_orders(daily_report_id, order_quantities):
+    """Write only the order rows that differ from what is stored for the report."""
+    existing = dict(
+        db_execute(
+            "SELECT material_id, quantity FROM daily_report_orders WHERE daily_report_id = ?",
+            (daily_report_id,),
+        ).all()
+    )
+    db_executemany(
+        "DELETE FROM daily_report_orders WHERE daily_report_id = ? AND material_id = ?",
+        (
+            (daily_report_id, material_id)
+            for material_id in existing.keys() - order_quantities.keys()
+        ),
+    )
+    # 存在しない材料 ID は INSERT ... SELECT で読み捨てる（材料一覧を別途引かない）
+    db_executemany(
         """
-        SELECT im.material_id,
-               COALESCE(
-                   SUM(
-                       CASE
-                           WHEN mt.name IN ('出庫', '廃棄') THEN -im.quantity
-                           ELSE im.quantity
-                       END
-                   ),
-                   0
-               ) AS store_stock
-        FROM inventory_movements im
-        JOIN movement_types mt ON im.movement_type_id = mt.id
-        WHERE im.store_id = ?
-        GROUP BY im.material_id
+        INSERT INTO daily_report_orders (daily_report_id, material_id, quantity)
+        SELECT ?, id, ? FROM materials WHERE id = ?
+        ON CONFLICT (daily_report_id, material_id) DO UPDATE
+        SET quantity = excluded.quantity
         """,
-        (store_id,),
+        (
+            (daily_report_id, quantity, material_id)
+            for material_id, quantity in order_quantities.items()
+            if existing.get(material_id) != quantity
+        ),
     )
-    return {row["material_id"]: row["store_stock"] for row in rows}
 
 
-def build_daily_report_line_message(report, store_name, orders):
-    def fmt_yen(value):
-        if value is None:
-            return "未入力"
-        try:
-            return f"{int(round(float(value))):,}円"
-        except (TypeError, ValueError):
-            return str(value)
+def sync_stocktake_order_items(session_id, order_quantities):
+    """Write only the order rows that differ from what is stored for the session."""
+    existing = dict(
+        db_execute(
+            "SELECT material_id, quantity FROM stocktake_order_items WHERE session_id = ?",
+            (session_id,),
+        ).all()
+    )
+    db_executemany(
+        "DELETE FROM stocktake_order_items WHERE session_id = ? AND material_id = ?",
+        (
+            (session_id, material_id)
+            for material_id in existing.keys() - order_quantities.keys()
+        ),
+    )
+    db_executemany(
+        """
+        INSERT INTO stocktake_order_items (session_id, material_id, quantity)
+        VALUES (?, ?, ?)
+        ON CONFLICT (session_id, material_id) DO UPDATE
+        SET quantity = excluded.quantity
+        """,
+        (
+            (session_id, material_id, quantity)
+            for material_id, quantity in order_quantities.items()
+            if existing.get(material_id) != quantity
+        ),
+    )
 
-    def fmt_hours(value):
-        if value is None:
-            return "未入力"
-        try:
-            return f"{float(value):g}h"
-        except (TypeError, ValueError):
-            return str(value)
 
-    def fmt_dt(value):
-        if not value:
-            return "未入力"
-        return str(value).replace("T", " ")
+def format_yen(value):
+    if value is None:
+        return "未入力"
+    try:
+        return f"{int(round(float(value))):,}円"
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def format_hours(value):
+    if value is None:
+        return "未入力"
+    try:
+        return f"{float(value):g}h"
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def format_number(value):
+    if value is None:
+        return "未入力"
+    try:
+        return f"{float(value):g}"
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def format_datetime_text(value):
+    if not value:
+        return "未入力"
+    return str(value).replace("T", " ")
+
+
+DAILY_REPORT_LINE_TEMPLATE = (
+    "【日報】{store_name} {date}\n"
+    "売上: {sales}\n"
+    "販売セット数: {production_sets}\n"
+    "処分たこ焼き数: {wasted_takoyaki}\n"
+    "営業時間: {working_hours}\n"
+    "{productivity_line}"
+    "次回材料受け取り: {next_material_delivery}\n"
+    "{orders_block}\n"
+    "所感・気付き・困りごと:\n"
+    "{remarks}"
+)
+
 
+def build_daily_report_line_message(report, store_name, orders):
     sales = report["sales"]
     production_sets = report["production_sets"]
     wasted_takoyaki = report["wasted_takoyaki"]
     working_hours = report["working_hours"]
 
-    def fmt_number(value):
-        if value is None:
-            return "未入力"
-        try:
-            return f"{float(value):g}"
-        except (TypeError, ValueError):
-            return str(value)
     productivity_sets = None
     productivity_sales = None
     if working_hours and working_hours > 0:
@@ -872,37 +1540,37 @@ def build_daily_report_line_message(report, store_name, orders):
         if sales is not None:
             productivity_sales = sales / working_hours
 
-    lines = [
-        f"【日報】{store_name} {report['date']}",
-        f"売上: {fmt_yen(sales)}",
-        f"販売セット数: {fmt_number(production_sets)}",
-        f"処分たこ焼き数: {fmt_number(wasted_takoyaki)}",
-        f"営業時間: {fmt_hours(working_hours)}",
-    ]
+    productivity_line = ""
     if productivity_sets is not None or productivity_sales is not None:
         prod_parts = []
         if productivity_sets is not None:
             prod_parts.append(f"{productivity_sets:.2f}セット/h")
         if productivity_sales is not None:
             prod_parts.append(f"{int(round(productivity_sales)):,}円/h")
-        lines.append(f"生産性: {', '.join(prod_parts)}")
-
-    lines.append(f"次回材料受け取り: {fmt_dt(report['next_material_delivery'])}")
+        productivity_line = f"生産性: {', '.join(prod_parts)}\n"
 
     if orders:
-        lines.append("発注（不足在庫）:")
-        for order in orders:
-            lines.append(
-                f"- {order['material_name']}: {int(order['quantity'])} {order['unit']}"
-            )
+        orders_block = "発注（不足在庫）:" + "".join(
+            f"\n- {order['material_name']}: {int(order['quantity'])} {order['unit']}"
+            for order in orders
+        )
     else:
-        lines.append("発注（不足在庫）: なし")
+        orders_block = "発注（不足在庫）: なし"
 
     remarks = (report["remarks"] or "").strip()
-    lines.append("所感・気付き・困りごと:")
-    lines.append(remarks if remarks else "（未入力）")
 
-    return "\n".join(lines)
+    return DAILY_REPORT_LINE_TEMPLATE.format(
+        store_name=store_name,
+        date=report["date"],
+        sales=format_yen(sales),
+        production_sets=format_number(production_sets),
+        wasted_takoyaki=format_number(wasted_takoyaki),
+        working_hours=format_hours(working_hours),
+        productivity_line=productivity_line,
+        next_material_delivery=format_datetime_text(report["next_material_delivery"]),
+        orders_block=orders_block,
+        remarks=remarks if remarks else "（未入力）",
+    )
 
 
 def build_stocktake_line_message(session, store_name, items, order_items):
@@ -945,55 +1613,43 @@ def build_stocktake_line_message(session, store_name, items, order_items):
 # 日報作成フォーム（GET）
 # ---------------------------------------------
 @app.route("/daily_reports/add", methods=["GET"])
-@login_required
-def daily_report_add_form():
-    stores = db_fetchall("SELECT id, name FROM stores ORDER BY id")
-    materials = db_fetchall(
-        """
-        SELECT m.id, m.name, m.unit, m.minimum_stock
-        FROM materials m
-        ORDER BY m.name
-        """
-    )
+@login_required
+def daily_report_add_form():
+    stores = get_stores()
 
     selected_store_id = current_user.store_id
     store_param = request.args.get("store_id")
     if is_admin_user() and store_param:
         parsed_store_id = parse_int(store_param)
-        if parsed_store_id and any(store["id"] == parsed_store_id for store in stores):
+        if parsed_store_id in get_store_ids():
             selected_store_id = parsed_store_id
 
-    store_stock = fetch_store_stock_levels(selected_store_id)
-    store_minimum_rows = db_fetchall(
-        "SELECT material_id, minimum_stock FROM material_store_minimums WHERE store_id = ?",
-        (selected_store_id,),
+    # 材料・店舗在庫・店舗別最低在庫量を 1 クエリで取得する
+    materials = db_execute(
+        """
+        SELECT m.id, m.name, m.unit,
+               COALESCE(msm.minimum_stock, m.minimum_stock) AS minimum_stock,
+               st.quantity AS stock
+        FROM materials m
+        LEFT JOIN material_store_minimums msm
+               ON msm.material_id = m.id AND msm.store_id = ?
+        LEFT JOIN material_store_stock st
+               ON st.material_id = m.id AND st.store_id = ?
+        ORDER BY m.name
+        """,
+        (selected_store_id, selected_store_id),
     )
-    store_minimums = {row["material_id"]: row["minimum_stock"] for row in store_minimum_rows}
 
     material_rows = []
-    for material in materials:
-        material_id = material["id"]
-        stock = store_stock.get(material_id, 0) or 0
-        minimum = store_minimums.get(material_id)
-        if minimum is None:
-            minimum = material["minimum_stock"]
-        shortage = None
-        recommended_order = 0
-        if minimum is not None:
-            try:
-                minimum_value = float(minimum)
-            except (TypeError, ValueError):
-                minimum_value = None
-            if minimum_value is not None and minimum_value > 0:
-                shortage = minimum_value - float(stock)
-                if shortage > 0:
-                    recommended_order = int(math.ceil(shortage))
+    for material_id, name, unit, minimum, stock in materials:
+        stock = stock or 0
+        recommended_order = recommended_order_quantity(minimum, stock)
 
         material_rows.append(
             {
                 "id": material_id,
-                "name": material["name"],
-                "unit": material["unit"],
+                "name": name,
+                "unit": unit,
                 "stock": stock,
                 "minimum": minimum,
                 "recommended_order": recommended_order,
@@ -1001,9 +1657,7 @@ def daily_report_add_form():
             }
         )
 
-    selected_store = next(
-        (store for store in stores if store["id"] == selected_store_id), None
-    )
+    selected_store = get_stores_by_id().get(selected_store_id)
     default_date = request.args.get("date") or date.today().isoformat()
 
     return render_template(
@@ -1023,99 +1677,58 @@ def daily_report_add_form():
 @app.route("/daily_reports/add", methods=["POST"])
 @login_required
 def daily_report_add():
-    report_date = (request.form.get("date") or "").strip()
+    form = request.form
+    report_date = (form.get("date") or "").strip()
     if not report_date:
         return "日付が未入力です。", 400
 
-    stores = db_fetchall("SELECT id FROM stores")
-    valid_store_ids = {store["id"] for store in stores}
+    valid_store_ids = get_store_ids()
 
     store_id = current_user.store_id
     if is_admin_user():
-        store_id = parse_int(request.form.get("store_id")) or store_id
+        store_id = parse_int(form.get("store_id")) or store_id
     if store_id not in valid_store_ids:
         return "店舗が不正です。", 400
 
-    sales = parse_float(request.form.get("sales"))
-    wasted_takoyaki = parse_int(request.form.get("wasted_takoyaki"))
-    production_sets = parse_float(request.form.get("production_sets"))
-    working_hours = parse_float(request.form.get("working_hours"))
-    next_material_delivery = (request.form.get("next_material_delivery") or "").strip() or None
-    remarks = (request.form.get("remarks") or "").strip() or None
+    sales = parse_float(form.get("sales"))
+    wasted_takoyaki = parse_int(form.get("wasted_takoyaki"))
+    production_sets = parse_float(form.get("production_sets"))
+    working_hours = parse_float(form.get("working_hours"))
+    next_material_delivery = (form.get("next_material_delivery") or "").strip() or None
+    remarks = (form.get("remarks") or "").strip() or None
 
-    existing = db_fetchone(
-        "SELECT id FROM daily_reports WHERE store_id = ? AND date = ?",
-        (store_id, report_date),
+    begin_write_transaction()
+    # 同じ店舗・日付の日報があれば上書きする
+    result = db_execute(
+        """
+        INSERT INTO daily_reports
+        (store_id, date, sales, wasted_takoyaki, production_sets, working_hours, next_material_delivery, remarks, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (store_id, date) DO UPDATE
+        SET sales = excluded.sales,
+            wasted_takoyaki = excluded.wasted_takoyaki,
+            production_sets = excluded.production_sets,
+            working_hours = excluded.working_hours,
+            next_material_delivery = excluded.next_material_delivery,
+            remarks = excluded.remarks,
+            updated_at = excluded.updated_at
+        RETURNING id
+        """,
+        (
+            store_id,
+            report_date,
+            sales,
+            wasted_takoyaki,
+            production_sets,
+            working_hours,
+            next_material_delivery,
+            remarks,
+            current_timestamp(),
+        ),
     )
+    daily_report_id = result.scalar()
 
-    if existing:
-        daily_report_id = existing["id"]
-        db_execute(
-            """
-            UPDATE daily_reports
-            SET sales = ?, wasted_takoyaki = ?, production_sets = ?, working_hours = ?,
-                next_material_delivery = ?, remarks = ?
-            WHERE id = ?
-            """,
-            (
-                sales,
-                wasted_takoyaki,
-                production_sets,
-                working_hours,
-                next_material_delivery,
-                remarks,
-                daily_report_id,
-            ),
-        )
-    else:
-        result = db_execute(
-            """
-            INSERT INTO daily_reports
-            (store_id, date, sales, wasted_takoyaki, production_sets, working_hours, next_material_delivery, remarks)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            RETURNING id
-            """,
-            (
-                store_id,
-                report_date,
-                sales,
-                wasted_takoyaki,
-                production_sets,
-                working_hours,
-                next_material_delivery,
-                remarks,
-            ),
-        )
-        daily_report_id = result.scalar()
-
-    materials = db_fetchall("SELECT id FROM materials")
-    material_ids = {material["id"] for material in materials}
-
-    order_items = []
-    for key, value in request.form.items():
-        if not key.startswith("order_qty_"):
-            continue
-        material_id = parse_int(key.replace("order_qty_", "", 1))
-        if not material_id or material_id not in material_ids:
-            continue
-        quantity = parse_int(value)
-        if quantity is None or quantity <= 0:
-            continue
-        order_items.append((daily_report_id, material_id, quantity))
-
-    db_execute(
-        "DELETE FROM daily_report_orders WHERE daily_report_id = ?",
-        (daily_report_id,),
-    )
-    if order_items:
-        for order_item in order_items:
-            db_execute(
-                """
-                INSERT INTO daily_report_orders (daily_report_id, material_id, quantity)
-                VALUES (?, ?, ?)
-                """,
-                order_item,
-            )
+    sync_daily_report_orders(daily_report_id, dict(parse_order_quantities(form)))
 
     db.session.commit()
 
@@ -1128,39 +1741,52 @@ def daily_report_add():
 @app.route("/daily_reports/<int:daily_report_id>")
 @login_required
 def daily_report_detail(daily_report_id):
-    report = db_fetchone(
+    # ブラウザが ETag を持っていれば、更新日時だけを見て 304 を返す
+    if request.if_none_match:
+        header = db_fetchone(
+            "SELECT store_id, updated_at FROM daily_reports WHERE id = ?",
+            (daily_report_id,),
+        )
+        if header and (is_admin_user() or header["store_id"] == current_user.store_id):
+            etag = detail_etag("daily_report", daily_report_id, header["updated_at"])
+            if request.if_none_match.contains_weak(etag):
+                return detail_response(b"", etag, status=304)
+
+    # 日報本体と発注明細を 1 クエリで取得する（発注がなければ明細列は NULL の 1 行）
+    rows = db_fetchall(
         """
-        SELECT dr.*, s.name AS store_name
+        SELECT dr.*, s.name AS store_name,
+               dro.quantity, m.name AS material_name, m.unit
         FROM daily_reports dr
         JOIN stores s ON dr.store_id = s.id
+        LEFT JOIN (
+            daily_report_orders dro
+            JOIN materials m ON dro.material_id = m.id
+        ) ON dro.daily_report_id = dr.id
         WHERE dr.id = ?
+        ORDER BY m.name
         """,
         (daily_report_id,),
     )
-    if not report:
+    if not rows:
         return "日報が見つかりません。", 404
 
+    report = rows[0]
     if not is_admin_user() and report["store_id"] != current_user.store_id:
         return "権限がありません。", 403
 
-    orders = db_fetchall(
-        """
-        SELECT dro.quantity, m.name AS material_name, m.unit
-        FROM daily_report_orders dro
-        JOIN materials m ON dro.material_id = m.id
-        WHERE dro.daily_report_id = ?
-        ORDER BY m.name
-        """,
-        (daily_report_id,),
-    )
+    orders = [row for row in rows if row["quantity"] is not None]
 
     line_message = build_daily_report_line_message(report, report["store_name"], orders)
 
-    return render_template(
-        "daily_report_detail.html",
-        report=report,
-        orders=orders,
-        line_message=line_message,
+    return detail_response(
+        render_template(
+            "daily_report_detail.html",
+            report=report,
+            orders=orders,
+            line_message=line_message,
+        ),
+        detail_etag("daily_report", daily_report_id, report["updated_at"]),
     )
 
 
@@ -1185,57 +1811,36 @@ def daily_report_edit_form(daily_report_id):
     if not is_admin_user() and report["store_id"] != current_user.store_id:
         return "権限がありません。", 403
 
-    stores = db_fetchall("SELECT id, name FROM stores ORDER BY id")
-    materials = db_fetchall(
+    stores = get_stores()
+    # 材料・店舗在庫・店舗別最低在庫量・登録済みの発注数を 1 クエリで取得する
+    materials = db_execute(
         """
-        SELECT m.id, m.name, m.unit, m.minimum_stock
+        SELECT m.id, m.name, m.unit,
+               COALESCE(msm.minimum_stock, m.minimum_stock) AS minimum_stock,
+               st.quantity AS stock,
+               dro.quantity AS order_qty
         FROM materials m
+        LEFT JOIN material_store_minimums msm
+               ON msm.material_id = m.id AND msm.store_id = ?
+        LEFT JOIN material_store_stock st
+               ON st.material_id = m.id AND st.store_id = ?
+        LEFT JOIN daily_report_orders dro
+               ON dro.material_id = m.id AND dro.daily_report_id = ?
         ORDER BY m.name
-        """
-    )
-
-    orders = db_fetchall(
-        """
-        SELECT dro.material_id, dro.quantity, m.name AS material_name, m.unit
-        FROM daily_report_orders dro
-        JOIN materials m ON dro.material_id = m.id
-        WHERE dro.daily_report_id = ?
         """,
-        (daily_report_id,),
+        (report["store_id"], report["store_id"], daily_report_id),
     )
-    order_quantities = {row["material_id"]: row["quantity"] for row in orders}
-
-    store_stock = fetch_store_stock_levels(report["store_id"])
-    store_minimum_rows = db_fetchall(
-        "SELECT material_id, minimum_stock FROM material_store_minimums WHERE store_id = ?",
-        (report["store_id"],),
-    )
-    store_minimums = {row["material_id"]: row["minimum_stock"] for row in store_minimum_rows}
 
     material_rows = []
-    for material in materials:
-        material_id = material["id"]
-        stock = store_stock.get(material_id, 0) or 0
-        minimum = store_minimums.get(material_id)
-        if minimum is None:
-            minimum = material["minimum_stock"]
-        recommended_order = 0
-        if minimum is not None:
-            try:
-                minimum_value = float(minimum)
-            except (TypeError, ValueError):
-                minimum_value = None
-            if minimum_value is not None and minimum_value > 0:
-                shortage = minimum_value - float(stock)
-                if shortage > 0:
-                    recommended_order = int(math.ceil(shortage))
-
-        existing_order = order_quantities.get(material_id)
+    for material_id, name, unit, minimum, stock, existing_order in materials:
+        stock = stock or 0
+        recommended_order = recommended_order_quantity(minimum, stock)
+
         material_rows.append(
             {
                 "id": material_id,
-                "name": material["name"],
-                "unit": material["unit"],
+                "name": name,
+                "unit": unit,
                 "stock": stock,
                 "minimum": minimum,
                 "recommended_order": recommended_order,
@@ -1259,7 +1864,8 @@ def daily_report_edit_form(daily_report_id):
 @app.route("/daily_reports/<int:daily_report_id>/edit", methods=["POST"])
 @login_required
 def daily_report_edit(daily_report_id):
-    report = db_fetchone("SELECT * FROM daily_reports WHERE id = ?", (daily_report_id,))
+    form = request.form
+    report = db_fetchone(DAILY_REPORT_SQL, (daily_report_id,))
     if not report:
         return "日報が見つかりません。", 404
 
@@ -1268,12 +1874,13 @@ def daily_report_edit(daily_report_id):
 
     store_id = report["store_id"]
     if is_admin_user():
-        store_id = parse_int(request.form.get("store_id")) or store_id
+        store_id = parse_int(form.get("store_id")) or store_id
 
-    report_date = (request.form.get("date") or "").strip()
+    report_date = (form.get("date") or "").strip()
     if not report_date:
         return "日付が未入力です。", 400
 
+    begin_write_transaction()
     conflict = db_fetchone(
         """
         SELECT id FROM daily_reports
@@ -1284,18 +1891,18 @@ def daily_report_edit(daily_report_id):
     if conflict:
         return "同じ店舗・同じ日付の日報が既に存在します。", 400
 
-    sales = parse_float(request.form.get("sales"))
-    wasted_takoyaki = parse_int(request.form.get("wasted_takoyaki"))
-    production_sets = parse_float(request.form.get("production_sets"))
-    working_hours = parse_float(request.form.get("working_hours"))
-    next_material_delivery = (request.form.get("next_material_delivery") or "").strip() or None
-    remarks = (request.form.get("remarks") or "").strip() or None
+    sales = parse_float(form.get("sales"))
+    wasted_takoyaki = parse_int(form.get("wasted_takoyaki"))
+    production_sets = parse_float(form.get("production_sets"))
+    working_hours = parse_float(form.get("working_hours"))
+    next_material_delivery = (form.get("next_material_delivery") or "").strip() or None
+    remarks = (form.get("remarks") or "").strip() or None
 
     db_execute(
         """
         UPDATE daily_reports
         SET store_id = ?, date = ?, sales = ?, wasted_takoyaki = ?, production_sets = ?,
-            working_hours = ?, next_material_delivery = ?, remarks = ?
+            working_hours = ?, next_material_delivery = ?, remarks = ?, updated_at = ?
         WHERE id = ?
         """,
         (
@@ -1307,38 +1914,12 @@ def daily_report_edit(daily_report_id):
             working_hours,
             next_material_delivery,
             remarks,
+            current_timestamp(),
             daily_report_id,
         ),
     )
 
-    materials = db_fetchall("SELECT id FROM materials")
-    material_ids = {material["id"] for material in materials}
-
-    order_items = []
-    for key, value in request.form.items():
-        if not key.startswith("order_qty_"):
-            continue
-        material_id = parse_int(key.replace("order_qty_", "", 1))
-        if not material_id or material_id not in material_ids:
-            continue
-        quantity = parse_int(value)
-        if quantity is None or quantity <= 0:
-            continue
-        order_items.append((daily_report_id, material_id, quantity))
-
-    db_execute(
-        "DELETE FROM daily_report_orders WHERE daily_report_id = ?",
-        (daily_report_id,),
-    )
-    if order_items:
-        for order_item in order_items:
-            db_execute(
-                """
-                INSERT INTO daily_report_orders (daily_report_id, material_id, quantity)
-                VALUES (?, ?, ?)
-                """,
-                order_item,
-            )
+    sync_daily_report_orders(daily_report_id, dict(parse_order_quantities(form)))
 
     db.session.commit()
     return redirect(f"/daily_reports/{daily_report_id}")
@@ -1350,12 +1931,13 @@ def daily_report_edit(daily_report_id):
 @app.route("/daily_reports/<int:daily_report_id>/delete", methods=["POST"])
 @login_required
 def daily_report_delete(daily_report_id):
-    report = db_fetchone("SELECT * FROM daily_reports WHERE id = ?", (daily_report_id,))
+    report = db_fetchone(DAILY_REPORT_SQL, (daily_report_id,))
     if not report:
         return "日報が見つかりません。", 404
     if not is_admin_user() and report["store_id"] != current_user.store_id:
         return "権限がありません。", 403
 
+    begin_write_transaction()
     db_execute(
         "DELETE FROM daily_report_orders WHERE daily_report_id = ?",
         (daily_report_id,),
@@ -1372,13 +1954,13 @@ def daily_report_delete(daily_report_id):
 @app.route("/stocktakes")
 @login_required
 def stocktake_list():
-    stores = db_fetchall("SELECT id, name FROM stores ORDER BY id")
+    stores = get_stores()
 
     selected_store_id = current_user.store_id
     store_param = request.args.get("store_id")
     if is_admin_user() and store_param:
         parsed_store_id = parse_int(store_param)
-        if parsed_store_id and any(store["id"] == parsed_store_id for store in stores):
+        if parsed_store_id in get_store_ids():
             selected_store_id = parsed_store_id
 
     sessions = db_fetchall(
@@ -1392,9 +1974,7 @@ def stocktake_list():
         (selected_store_id,),
     )
 
-    selected_store = next(
-        (store for store in stores if store["id"] == selected_store_id), None
-    )
+    selected_store = get_stores_by_id().get(selected_store_id)
     return render_template(
         "stocktake_list.html",
         sessions=sessions,
@@ -1411,52 +1991,41 @@ def stocktake_list():
 @app.route("/stocktakes/add", methods=["GET"])
 @login_required
 def stocktake_add_form():
-    stores = db_fetchall("SELECT id, name FROM stores ORDER BY id")
-    materials = db_fetchall(
-        """
-        SELECT m.id, m.name, m.unit, m.minimum_stock
-        FROM materials m
-        ORDER BY m.name
-        """
-    )
+    stores = get_stores()
 
     selected_store_id = current_user.store_id
     store_param = request.args.get("store_id")
     if is_admin_user() and store_param:
         parsed_store_id = parse_int(store_param)
-        if parsed_store_id and any(store["id"] == parsed_store_id for store in stores):
+        if parsed_store_id in get_store_ids():
             selected_store_id = parsed_store_id
 
-    store_stock = fetch_store_stock_levels(selected_store_id)
-    store_minimum_rows = db_fetchall(
-        "SELECT material_id, minimum_stock FROM material_store_minimums WHERE store_id = ?",
-        (selected_store_id,),
+    # 材料・店舗在庫・店舗別最低在庫量を 1 クエリで取得する
+    materials = db_execute(
+        """
+        SELECT m.id, m.name, m.unit,
+               COALESCE(msm.minimum_stock, m.minimum_stock) AS minimum_stock,
+               st.quantity AS stock
+        FROM materials m
+        LEFT JOIN material_store_minimums msm
+               ON msm.material_id = m.id AND msm.store_id = ?
+        LEFT JOIN material_store_stock st
+               ON st.material_id = m.id AND st.store_id = ?
+        ORDER BY m.name
+        """,
+        (selected_store_id, selected_store_id),
     )
-    store_minimums = {row["material_id"]: row["minimum_stock"] for row in store_minimum_rows}
 
     material_rows = []
-    for material in materials:
-        material_id = material["id"]
-        system_stock = store_stock.get(material_id, 0) or 0
-        minimum = store_minimums.get(material_id)
-        if minimum is None:
-            minimum = material["minimum_stock"]
-        recommended_order = 0
-        if minimum is not None:
-            try:
-                minimum_value = float(minimum)
-            except (TypeError, ValueError):
-                minimum_value = None
-            if minimum_value is not None and minimum_value > 0:
-                shortage = minimum_value - float(system_stock)
-                if shortage > 0:
-                    recommended_order = int(math.ceil(shortage))
+    for material_id, name, unit, minimum, stock in materials:
+        system_stock = stock or 0
+        recommended_order = recommended_order_quantity(minimum, system_stock)
 
         material_rows.append(
             {
                 "id": material_id,
-                "name": material["name"],
-                "unit": material["unit"],
+                "name": name,
+                "unit": unit,
                 "system_stock": system_stock,
                 "minimum": minimum,
                 "recommended_order": recommended_order,
@@ -1464,9 +2033,7 @@ def stocktake_add_form():
             }
         )
 
-    selected_store = next(
-        (store for store in stores if store["id"] == selected_store_id), None
-    )
+    selected_store = get_stores_by_id().get(selected_store_id)
     default_date = request.args.get("date") or date.today().isoformat()
 
     session_type = (request.args.get("type") or "ad_hoc").strip()
@@ -1474,18 +2041,11 @@ def stocktake_add_form():
         session_type = "ad_hoc"
     count_month = (request.args.get("month") or "").strip()
     if session_type == "monthly":
-        if not re.match(r"^\d{4}-\d{2}$", count_month):
+        if not is_year_month(count_month):
             count_month = date.today().strftime("%Y-%m")
+        year, month = map(int, count_month.split("-", 1))
         try:
-            year, month = map(int, count_month.split("-", 1))
-            if not (1 <= month <= 12):
-                raise ValueError
-            first_day = date(year, month, 1)
-            if month == 12:
-                next_month = date(year + 1, 1, 1)
-            else:
-                next_month = date(year, month + 1, 1)
-            default_date = (next_month - timedelta(days=1)).isoformat()
+            default_date = date(year, month, calendar.monthrange(year, month)[1]).isoformat()
         except ValueError:
             session_type = "ad_hoc"
             count_month = ""
@@ -1509,48 +2069,52 @@ def stocktake_add_form():
 @app.route("/stocktakes/add", methods=["POST"])
 @login_required
 def stocktake_add():
-    count_date = (request.form.get("date") or "").strip()
+    form = request.form
+    count_date = (form.get("date") or "").strip()
     if not count_date:
         return "棚卸日が未入力です。", 400
 
-    session_type = (request.form.get("session_type") or "ad_hoc").strip()
+    session_type = (form.get("session_type") or "ad_hoc").strip()
     if session_type not in ("ad_hoc", "monthly"):
         session_type = "ad_hoc"
-    count_month = (request.form.get("count_month") or "").strip() or None
+    count_month = (form.get("count_month") or "").strip() or None
     if session_type == "monthly":
         if count_month is None:
             count_month = count_date[:7]
-        if not re.match(r"^\d{4}-\d{2}$", count_month):
-            return "月次棚卸しの対象月が不正です。", 400
-        try:
-            year, month = map(int, count_month.split("-", 1))
-            if not (1 <= month <= 12):
-                raise ValueError
-        except ValueError:
+        if not is_year_month(count_month):
             return "月次棚卸しの対象月が不正です。", 400
     else:
         count_month = None
 
-    stores = db_fetchall("SELECT id FROM stores")
-    valid_store_ids = {store["id"] for store in stores}
+    valid_store_ids = get_store_ids()
 
     store_id = current_user.store_id
     if is_admin_user():
-        store_id = parse_int(request.form.get("store_id")) or store_id
+        store_id = parse_int(form.get("store_id")) or store_id
     if store_id not in valid_store_ids:
         return "店舗が不正です。", 400
 
-    notes = (request.form.get("notes") or "").strip() or None
+    notes = (form.get("notes") or "").strip() or None
 
+    begin_write_transaction()
     try:
         result = db_execute(
             """
             INSERT INTO stocktake_sessions
-            (company_id, store_id, count_date, session_type, count_month, status, notes)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            (company_id, store_id, count_date, session_type, count_month, status, notes, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             RETURNING id
             """,
-            (None, store_id, count_date, session_type, count_month, "draft", notes),
+            (
+                None,
+                store_id,
+                count_date,
+                session_type,
+                count_month,
+                "draft",
+                notes,
+                current_timestamp(),
+            ),
         )
         session_id = result.scalar()
     except IntegrityError:
@@ -1559,49 +2123,37 @@ def stocktake_add():
             return "この店舗の月次棚卸しは既に作成されています。", 400
         raise
 
-    materials = db_fetchall("SELECT id FROM materials")
-    material_ids = {material["id"] for material in materials}
+    material_ids = set(db_execute("SELECT id FROM materials").scalars())
 
     items = []
     for material_id in material_ids:
         key = f"count_qty_{material_id}"
-        value = request.form.get(key)
+        value = form.get(key)
         counted = parse_float(value)
         if counted is None:
             db.session.rollback()
             return "全ての材料の棚卸数を入力してください。", 400
         items.append((session_id, material_id, counted))
 
-    for item in items:
-        db_execute(
-            """
-            INSERT INTO stocktake_items (session_id, material_id, counted_quantity)
-            VALUES (?, ?, ?)
-            """,
-            item,
-        )
-
-    order_items = []
-    for key, value in request.form.items():
-        if not key.startswith("order_qty_"):
-            continue
-        material_id = parse_int(key.replace("order_qty_", "", 1))
-        if not material_id or material_id not in material_ids:
-            continue
-        quantity = parse_int(value)
-        if quantity is None or quantity <= 0:
-            continue
-        order_items.append((session_id, material_id, quantity))
+    db_executemany(
+        """
+        INSERT INTO stocktake_items (session_id, material_id, counted_quantity)
+        VALUES (?, ?, ?)
+        """,
+        items,
+    )
 
-    if order_items:
-        for order_item in order_items:
-            db_execute(
-                """
-                INSERT INTO stocktake_order_items (session_id, material_id, quantity)
-                VALUES (?, ?, ?)
-                """,
-                order_item,
-            )
+    db_executemany(
+        """
+        INSERT INTO stocktake_order_items (session_id, material_id, quantity)
+        VALUES (?, ?, ?)
+        """,
+        (
+            (session_id, material_id, quantity)
+            for material_id, quantity in parse_order_quantities(form)
+            if material_id in material_ids
+        ),
+    )
 
     db.session.commit()
 
@@ -1615,17 +2167,13 @@ def stocktake_add():
 @login_required
 def monthly_stocktakes():
     month = (request.args.get("month") or date.today().strftime("%Y-%m")).strip()
-    if not re.match(r"^\d{4}-\d{2}$", month):
+    if not is_year_month(month):
         month = date.today().strftime("%Y-%m")
 
-    stores = db_fetchall("SELECT id, name FROM stores ORDER BY id")
+    stores = get_stores()
     materials = db_fetchall(
         "SELECT id, name, unit, price_per_unit FROM materials ORDER BY name"
     )
-    price_by_material = {
-        material["id"]: material.get("price_per_unit") for material in materials
-    }
-
     sessions = db_fetchall(
         """
         SELECT ss.*, s.name AS store_name
@@ -1638,37 +2186,46 @@ def monthly_stocktakes():
     )
     sessions_by_store = {row["store_id"]: row for row in sessions}
 
-    count_rows = db_fetchall(
-        """
-        SELECT ss.store_id, si.material_id, si.counted_quantity
-        FROM stocktake_sessions ss
-        JOIN stocktake_items si ON si.session_id = ss.id
-        WHERE ss.session_type = 'monthly' AND ss.count_month = ?
-        """,
-        (month,),
-    )
-    counts = {}
-    values = {}
-    store_totals = {store["id"]: 0.0 for store in stores}
+    # 材料 × 店舗の棚卸数と金額を SQL 側で横持ちに集計する
+    # （列名 c<store_id> が数量、v<store_id> が金額。単価が数値でない旧データは金額なし）
+    store_ids = [store["id"] for store in stores]
+    pivot_columns = ",\n".join(
+        f"SUM(CASE WHEN ss.store_id = ? THEN si.counted_quantity END) AS c{store_id},\n"
+        f"SUM(CASE WHEN ss.store_id = ? AND m.price_per_unit + 0 = m.price_per_unit"
+        f" THEN si.counted_quantity * m.price_per_unit END) AS v{store_id}"
+        for store_id in store_ids
+    )
+    pivot_params = [store_id for store_id in store_ids for _ in range(2)]
+    count_rows = []
+    if store_ids:
+        count_rows = db_fetchall(
+            f"""
+            SELECT si.material_id,
+                   {pivot_columns}
+            FROM stocktake_sessions ss
+            JOIN stocktake_items si ON si.session_id = ss.id
+            JOIN materials m ON si.material_id = m.id
+            WHERE ss.session_type = 'monthly' AND ss.count_month = ?
+            GROUP BY si.material_id
+            """,
+            (*pivot_params, month),
+        )
+    counts = {row["material_id"]: row for row in count_rows}
+
+    store_totals = {store_id: 0.0 for store_id in store_ids}
     material_totals = {material["id"]: 0.0 for material in materials}
     overall_total = 0.0
+    value_keys = [(store_id, f"v{store_id}") for store_id in store_ids]
     for row in count_rows:
-        material_id = row["material_id"]
-        store_id = row["store_id"]
-        qty = row["counted_quantity"]
-        counts.setdefault(material_id, {})[store_id] = qty
-
-        price = price_by_material.get(material_id)
-        if price is None or qty is None:
-            continue
-        try:
-            value = float(qty) * float(price)
-        except (TypeError, ValueError):
-            continue
-        values.setdefault(material_id, {})[store_id] = value
-        store_totals[store_id] += value
-        material_totals[material_id] += value
-        overall_total += value
+        material_total = 0.0
+        for store_id, value_key in value_keys:
+            value = row[value_key]
+            if value is None:
+                continue
+            store_totals[store_id] += value
+            material_total += value
+        material_totals[row["material_id"]] = material_total
+        overall_total += material_total
 
     return render_template(
         "monthly_stocktakes.html",
@@ -1677,7 +2234,6 @@ def monthly_stocktakes():
         materials=materials,
         sessions_by_store=sessions_by_store,
         counts=counts,
-        values=values,
         store_totals=store_totals,
         material_totals=material_totals,
         overall_total=overall_total,
@@ -1692,52 +2248,63 @@ def monthly_stocktakes():
 @app.route("/stocktakes/<int:session_id>")
 @login_required
 def stocktake_detail(session_id):
-    session = db_fetchone(
-        """
-        SELECT ss.*, s.name AS store_name
-        FROM stocktake_sessions ss
-        JOIN stores s ON ss.store_id = s.id
-        WHERE ss.id = ?
-        """,
-        (session_id,),
-    )
+    session = db_fetchone(STOCKTAKE_SESSION_WITH_STORE_SQL, (session_id,))
     if not session:
         return "棚卸が見つかりません。", 404
 
     if not is_admin_user() and session["store_id"] != current_user.store_id:
         return "権限がありません。", 403
 
-    items = db_fetchall(
+    # ブラウザの ETag が最新なら明細を読まずに 304 を返す
+    etag = detail_etag("stocktake", session_id, session["updated_at"])
+    if request.if_none_match.contains_weak(etag):
+        return detail_response(b"", etag, status=304)
+
+    # 棚卸明細（kind 0）と発注明細（kind 1）を 1 クエリで取得する
+    rows = db_fetchall(
         """
-        SELECT si.counted_quantity, m.name AS material_name, m.unit, m.id AS material_id
+        SELECT 0 AS kind, si.counted_quantity AS quantity,
+               m.name AS material_name, m.unit, m.id AS material_id
         FROM stocktake_items si
         JOIN materials m ON si.material_id = m.id
         WHERE si.session_id = ?
-        ORDER BY m.name
-        """,
-        (session_id,),
-    )
-
-    order_items = db_fetchall(
-        """
-        SELECT soi.quantity, m.name AS material_name, m.unit, m.id AS material_id
+        UNION ALL
+        SELECT 1 AS kind, soi.quantity,
+               m.name AS material_name, m.unit, m.id AS material_id
         FROM stocktake_order_items soi
         JOIN materials m ON soi.material_id = m.id
         WHERE soi.session_id = ?
-        ORDER BY m.name
+        ORDER BY kind, material_name
         """,
-        (session_id,),
+        (session_id, session_id),
     )
+    items = []
+    order_items = []
+    for row in rows:
+        if row["kind"] == 0:
+            items.append(
+                {
+                    "counted_quantity": row["quantity"],
+                    "material_name": row["material_name"],
+                    "unit": row["unit"],
+                    "material_id": row["material_id"],
+                }
+            )
+        else:
+            order_items.append(row)
 
     line_message = build_stocktake_line_message(
         session, session["store_name"], items, order_items
     )
-    return render_template(
-        "stocktake_detail.html",
-        session=session,
-        items=items,
-        order_items=order_items,
-        line_message=line_message,
+    return detail_response(
+        render_template(
+            "stocktake_detail.html",
+            session=session,
+            items=items,
+            order_items=order_items,
+            line_message=line_message,
+        ),
+        etag,
     )
 
 
@@ -1747,15 +2314,7 @@ def stocktake_detail(session_id):
 @app.route("/stocktakes/<int:session_id>/edit", methods=["GET"])
 @login_required
 def stocktake_edit_form(session_id):
-    session = db_fetchone(
-        """
-        SELECT ss.*, s.name AS store_name
-        FROM stocktake_sessions ss
-        JOIN stores s ON ss.store_id = s.id
-        WHERE ss.id = ?
-        """,
-        (session_id,),
-    )
+    session = db_fetchone(STOCKTAKE_SESSION_WITH_STORE_SQL, (session_id,))
     if not session:
         return "棚卸が見つかりません。", 404
     if not is_admin_user() and session["store_id"] != current_user.store_id:
@@ -1763,70 +2322,47 @@ def stocktake_edit_form(session_id):
     if session["status"] == "confirmed":
         return "確定済みの棚卸は編集できません。", 403
 
-    stores = db_fetchall("SELECT id, name FROM stores ORDER BY id")
-    materials = db_fetchall(
+    stores = get_stores()
+    # 材料・店舗在庫・店舗別最低在庫量・入力済みの棚卸数と発注数を 1 クエリで取得する
+    # （counted_quantity は NOT NULL なので、NULL は未入力を表す）
+    materials = db_execute(
         """
-        SELECT m.id, m.name, m.unit, m.minimum_stock
+        SELECT m.id, m.name, m.unit,
+               COALESCE(msm.minimum_stock, m.minimum_stock) AS minimum_stock,
+               st.quantity AS stock,
+               si.counted_quantity,
+               soi.quantity AS order_qty
         FROM materials m
+        LEFT JOIN material_store_minimums msm
+               ON msm.material_id = m.id AND msm.store_id = ?
+        LEFT JOIN material_store_stock st
+               ON st.material_id = m.id AND st.store_id = ?
+        LEFT JOIN stocktake_items si
+               ON si.material_id = m.id AND si.session_id = ?
+        LEFT JOIN stocktake_order_items soi
+               ON soi.material_id = m.id AND soi.session_id = ?
         ORDER BY m.name
-        """
-    )
-
-    item_rows = db_fetchall(
-        """
-        SELECT material_id, counted_quantity
-        FROM stocktake_items
-        WHERE session_id = ?
-        """,
-        (session_id,),
-    )
-    counted_map = {row["material_id"]: row["counted_quantity"] for row in item_rows}
-
-    order_rows = db_fetchall(
-        """
-        SELECT material_id, quantity
-        FROM stocktake_order_items
-        WHERE session_id = ?
         """,
-        (session_id,),
-    )
-    order_map = {row["material_id"]: row["quantity"] for row in order_rows}
-
-    store_stock = fetch_store_stock_levels(session["store_id"])
-    store_minimum_rows = db_fetchall(
-        "SELECT material_id, minimum_stock FROM material_store_minimums WHERE store_id = ?",
-        (session["store_id"],),
+        (session["store_id"], session["store_id"], session_id, session_id),
     )
-    store_minimums = {row["material_id"]: row["minimum_stock"] for row in store_minimum_rows}
 
     material_rows = []
-    for material in materials:
-        material_id = material["id"]
-        system_stock = store_stock.get(material_id, 0) or 0
-        minimum = store_minimums.get(material_id)
-        if minimum is None:
-            minimum = material["minimum_stock"]
-        recommended_order = 0
-        if minimum is not None:
-            try:
-                minimum_value = float(minimum)
-            except (TypeError, ValueError):
-                minimum_value = None
-            if minimum_value is not None and minimum_value > 0:
-                shortage = minimum_value - float(counted_map.get(material_id, system_stock) or 0)
-                if shortage > 0:
-                    recommended_order = int(math.ceil(shortage))
+    for material_id, name, unit, minimum, stock, counted_qty, order_qty in materials:
+        system_stock = stock or 0
+        if counted_qty is None:
+            counted_qty = system_stock
+        recommended_order = recommended_order_quantity(minimum, counted_qty or 0)
 
         material_rows.append(
             {
                 "id": material_id,
-                "name": material["name"],
-                "unit": material["unit"],
+                "name": name,
+                "unit": unit,
                 "system_stock": system_stock,
                 "minimum": minimum,
-                "counted_qty": counted_map.get(material_id, system_stock),
+                "counted_qty": counted_qty,
                 "recommended_order": recommended_order,
-                "order_qty": order_map.get(material_id),
+                "order_qty": order_qty,
             }
         )
 
@@ -1845,7 +2381,10 @@ def stocktake_edit_form(session_id):
 @app.route("/stocktakes/<int:session_id>/edit", methods=["POST"])
 @login_required
 def stocktake_edit(session_id):
-    session = db_fetchone("SELECT * FROM stocktake_sessions WHERE id = ?", (session_id,))
+    form = request.form
+    # 確定済みかどうかの確認から更新までを一つの書き込みトランザクションで行う
+    begin_write_transaction()
+    session = db_fetchone(STOCKTAKE_SESSION_SQL, (session_id,))
     if not session:
         return "棚卸が見つかりません。", 404
     if not is_admin_user() and session["store_id"] != current_user.store_id:
@@ -1855,29 +2394,29 @@ def stocktake_edit(session_id):
 
     store_id = session["store_id"]
     if is_admin_user():
-        store_id = parse_int(request.form.get("store_id")) or store_id
+        store_id = parse_int(form.get("store_id")) or store_id
 
-    count_date = (request.form.get("date") or "").strip()
+    count_date = (form.get("date") or "").strip()
     if not count_date:
         return "棚卸日が未入力です。", 400
 
-    notes = (request.form.get("notes") or "").strip() or None
+    notes = (form.get("notes") or "").strip() or None
 
     session_type = (session["session_type"] or "ad_hoc").strip()
     count_month = None
     if session_type == "monthly":
         count_month = count_date[:7]
-        if not re.match(r"^\d{4}-\d{2}$", count_month):
+        if not is_year_month(count_month):
             return "月次棚卸しの棚卸日が不正です。", 400
 
     try:
         db_execute(
             """
             UPDATE stocktake_sessions
-            SET store_id = ?, count_date = ?, count_month = ?, notes = ?
+            SET store_id = ?, count_date = ?, count_month = ?, notes = ?, updated_at = ?
             WHERE id = ?
             """,
-            (store_id, count_date, count_month, notes, session_id),
+            (store_id, count_date, count_month, notes, current_timestamp(), session_id),
         )
     except IntegrityError:
         db.session.rollback()
@@ -1885,54 +2424,45 @@ def stocktake_edit(session_id):
             return "この店舗の月次棚卸しは既に作成されています。", 400
         raise
 
-    materials = db_fetchall("SELECT id FROM materials")
-    material_ids = {material["id"] for material in materials}
+    material_ids = set(db_execute("SELECT id FROM materials").scalars())
 
     items = []
     for material_id in material_ids:
         key = f"count_qty_{material_id}"
-        value = request.form.get(key)
+        value = form.get(key)
         counted = parse_float(value)
         if counted is None:
             db.session.rollback()
             return "全ての材料の棚卸数を入力してください。", 400
         items.append((session_id, material_id, counted))
 
-    db_execute("DELETE FROM stocktake_items WHERE session_id = ?", (session_id,))
-    for item in items:
-        db_execute(
-            """
-            INSERT INTO stocktake_items (session_id, material_id, counted_quantity)
-            VALUES (?, ?, ?)
-            """,
-            item,
-        )
-
-    order_items = []
-    for key, value in request.form.items():
-        if not key.startswith("order_qty_"):
-            continue
-        material_id = parse_int(key.replace("order_qty_", "", 1))
-        if not material_id or material_id not in material_ids:
-            continue
-        quantity = parse_int(value)
-        if quantity is None or quantity <= 0:
-            continue
-        order_items.append((session_id, material_id, quantity))
-
+    # 値が変わった行だけを書き換え、削除済み材料の行だけを消す
     db_execute(
-        "DELETE FROM stocktake_order_items WHERE session_id = ?",
+        """
+        DELETE FROM stocktake_items
+        WHERE session_id = ? AND material_id NOT IN (SELECT id FROM materials)
+        """,
         (session_id,),
     )
-    if order_items:
-        for order_item in order_items:
-            db_execute(
-                """
-                INSERT INTO stocktake_order_items (session_id, material_id, quantity)
-                VALUES (?, ?, ?)
-                """,
-                order_item,
-            )
+    db_executemany(
+        """
+        INSERT INTO stocktake_items (session_id, material_id, counted_quantity)
+        VALUES (?, ?, ?)
+        ON CONFLICT (session_id, material_id) DO UPDATE
+        SET counted_quantity = excluded.counted_quantity
+        WHERE stocktake_items.counted_quantity <> excluded.counted_quantity
+        """,
+        items,
+    )
+
+    sync_stocktake_order_items(
+        session_id,
+        {
+            material_id: quantity
+            for material_id, quantity in parse_order_quantities(form)
+            if material_id in material_ids
+        },
+    )
 
     db.session.commit()
     return redirect(f"/stocktakes/{session_id}")
@@ -1944,7 +2474,9 @@ def stocktake_edit(session_id):
 @app.route("/stocktakes/<int:session_id>/delete", methods=["POST"])
 @login_required
 def stocktake_delete(session_id):
-    session = db_fetchone("SELECT * FROM stocktake_sessions WHERE id = ?", (session_id,))
+    # 確定済みかどうかの確認から削除までを一つの書き込みトランザクションで行う
+    begin_write_transaction()
+    session = db_fetchone(STOCKTAKE_SESSION_SQL, (session_id,))
     if not session:
         return "棚卸が見つかりません。", 404
     if not is_admin_user() and session["store_id"] != current_user.store_id:
@@ -1966,7 +2498,9 @@ def stocktake_delete(session_id):
 @app.route("/stocktakes/<int:session_id>/confirm", methods=["POST"])
 @login_required
 def stocktake_confirm(session_id):
-    session = db_fetchone("SELECT * FROM stocktake_sessions WHERE id = ?", (session_id,))
+    # 確定済みかどうかの確認から調整の書き込みまでを一つの書き込みトランザクションで行う
+    begin_write_transaction()
+    session = db_fetchone(STOCKTAKE_SESSION_SQL, (session_id,))
     if not session:
         return "棚卸が見つかりません。", 404
     if not is_admin_user() and session["store_id"] != current_user.store_id:
@@ -1974,62 +2508,29 @@ def stocktake_confirm(session_id):
     if session["status"] == "confirmed":
         return redirect(f"/stocktakes/{session_id}")
 
-    items = db_fetchall(
-        """
-        SELECT si.material_id, si.counted_quantity, m.name AS material_name
-        FROM stocktake_items si
-        JOIN materials m ON si.material_id = m.id
-        WHERE si.session_id = ?
-        """,
-        (session_id,),
-    )
-
-    system_stock = fetch_store_stock_levels(session["store_id"])
-    movement_type = db_fetchone(
-        "SELECT id FROM movement_types WHERE name = '棚卸調整'"
-    )
-    movement_type_id = movement_type["id"] if movement_type else None
+    movement_type_id = get_movement_type_id("棚卸調整")
     if not movement_type_id:
         return "棚卸調整の入出庫種別が見つかりません。", 500
 
-    adjustments = []
-    for item in items:
-        material_id = item["material_id"]
-        counted = item["counted_quantity"]
-        current = system_stock.get(material_id, 0) or 0
-        diff = float(counted) - float(current)
-        if abs(diff) < 1e-9:
-            continue
-        memo = f"棚卸調整 (stocktake:{session_id})"
-        adjustments.append(
-            (
-                session["store_id"],
-                material_id,
-                movement_type_id,
-                diff,
-                session["count_date"],
-                memo,
-            )
-        )
-
-    if adjustments:
-        for adjustment in adjustments:
-            db_execute(
-                """
-                INSERT INTO inventory_movements
-                (store_id, material_id, movement_type_id, quantity, datetime, memo)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                adjustment,
-            )
+    db_execute(
+        STOCKTAKE_ADJUSTMENT_SQL,
+        (
+            session["store_id"],
+            movement_type_id,
+            session["count_date"],
+            f"棚卸調整 (stocktake:{session_id})",
+            session["store_id"],
+            session_id,
+        ),
+    )
 
     db_execute(
         """
         UPDATE stocktake_sessions
-        SET status = 'confirmed', confirmed_at = CURRENT_TIMESTAMP
+        SET status = 'confirmed', confirmed_at = CURRENT_TIMESTAMP, updated_at = ?
         WHERE id = ?
         """,
-        (session_id,),
+        (current_timestamp(), session_id),
     )
     db.session.commit()
 
@@ -2044,15 +2545,16 @@ def stocktake_confirm(session_id):
 def edit_movement_form(movement_id):
     movement = db_fetchone(
         """
-        SELECT * FROM inventory_movements
+        SELECT id, store_id, material_id, movement_type_id, quantity, datetime, memo
+        FROM inventory_movements
         WHERE id = ?
         """,
         (movement_id,),
     )
 
     materials = db_fetchall("SELECT id, name FROM materials")
-    movement_types = db_fetchall("SELECT id, name FROM movement_types")
-    stores = db_fetchall("SELECT id, name FROM stores")
+    movement_types = get_movement_types()
+    stores = get_stores()
 
     return render_template(
         "edit_movement.html",
@@ -2069,13 +2571,11 @@ def edit_movement_form(movement_id):
 @app.route("/movements/<int:movement_id>/edit", methods=["POST"])
 @login_required
 def edit_movement(movement_id):
-    store_id = request.form["store_id"]
-    material_id = request.form["material_id"]
-    movement_type_id = request.form["movement_type_id"]
-    quantity = request.form["quantity"]
-    datetime_value = request.form["datetime"]
-    memo = request.form.get("memo", "")
+    values = parse_movement_form(request.form)
+    if values is None:
+        return "必要な項目が未入力です。", 400
 
+    begin_write_transaction()
     db_execute(
         """
         UPDATE inventory_movements
@@ -2083,15 +2583,7 @@ def edit_movement(movement_id):
             quantity = ?, datetime = ?, memo = ?
         WHERE id = ?
         """,
-        (
-            store_id,
-            material_id,
-            movement_type_id,
-            quantity,
-            datetime_value,
-            memo,
-            movement_id,
-        ),
+        (*values, movement_id),
     )
     db.session.commit()
 
@@ -2104,11 +2596,39 @@ def edit_movement(movement_id):
 @app.route("/movements/<int:movement_id>/delete", methods=["POST"])
 @login_required
 def delete_movement(movement_id):
-    db_execute("DELETE FROM inventory_movements WHERE id = ?", (movement_id,))
-    db.session.commit()
+    delete_movements([movement_id])
+    return redirect("/movements")
+
 
+# ---------------------------------------------
+# 入出庫一括削除（POST）
+# ---------------------------------------------
+@app.route("/movements/delete_bulk", methods=["POST"])
+@login_required
+def delete_movements_bulk():
+    movement_ids = {parse_int(value) for value in request.form.getlist("ids")}
+    movement_ids.discard(None)
+    # 一覧の 1 ページ分を超える件数は受け付けない（SQLite のバインド変数の上限も避ける）
+    if len(movement_ids) > MOVEMENT_LIST_PAGE_SIZE:
+        return f"一度に削除できるのは {MOVEMENT_LIST_PAGE_SIZE} 件までです。", 400
+    if movement_ids:
+        delete_movements(sorted(movement_ids))
     return redirect("/movements")
 
 
+def delete_movements(movement_ids):
+    # 選択された入出庫をまとめて 1 トランザクション・1 文で削除する
+    placeholders = ", ".join("?" for _ in movement_ids)
+    begin_write_transaction()
+    db_execute(
+        f"DELETE FROM inventory_movements WHERE id IN ({placeholders})",
+        movement_ids,
+    )
+    db.session.commit()
+
+
+# 本番は開発サーバーではなく gunicorn などの WSGI サーバーで起動する
+#   gunicorn -w $(nproc) -k gthread --threads 4 app:app
+# python app.py での起動は開発用。デバッガ／リローダーは FLASK_DEV=1 のときだけ有効にする。
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(debug=bool(os.environ.get("FLASK_DEV")), threaded=True)